@@ -1,19 +1,181 @@
 import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import os
+import re
+import signal
 import socket
 import struct
-import threading
+import sys
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
 
 SAP_GRP, SAP_PORT = "224.2.127.254", 9875
 
+RECV_BATCH = 32
+RECV_BUF_SIZE = 65536
+RECV_SOCK_BUF = 4 * 1024 * 1024
+IP_MULTICAST_ALL = getattr(socket, "IP_MULTICAST_ALL", 49)  # Linux-only; not exported by the socket module
+FLUSH_INTERVAL = 0.1
+SWEEP_INTERVAL = 30
+WRITE_WORKERS = 2
+
+_SAP_HDR = struct.Struct("!BBH")
+_TITLE_RE = re.compile(r"^s=(.*)", re.MULTILINE)
+
+
+@dataclass(slots=True)
+class SapEntry:
+    title: str
+    path: str
+    last_seen: float
+    queued: float  # deadline of this session's live entry in the expiry heap
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IoVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fn = libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    fn.restype = ctypes.c_int
+    return fn
+
+
+class BatchReceiver:
+    """Drain up to `batch` queued datagrams per syscall with recvmmsg(2); one recv_into where unavailable.
+
+    Never blocks: returns an empty list when nothing is queued, so it can run from a readiness callback.
+    Datagrams are returned as views into the receive buffer and are only valid until the next recv().
+    """
+
+    def __init__(self, sock: socket.socket, batch: int = RECV_BATCH):
+        sock.setblocking(False)
+        self.sock = sock
+        self._recvmmsg = _load_recvmmsg()
+        if self._recvmmsg is None:
+            batch = 1
+
+        # One preallocated slot per datagram, reused for every receive.
+        self._buf = bytearray(batch * RECV_BUF_SIZE)
+        self._mv = memoryview(self._buf)
+        if self._recvmmsg is None:
+            return
+
+        self._cbuf = (ctypes.c_char * len(self._buf)).from_buffer(self._buf)
+        base = ctypes.addressof(self._cbuf)
+        self._iov = (_IoVec * batch)()
+        self._msgs = (_MMsgHdr * batch)()
+        for i in range(batch):
+            self._iov[i].iov_base = base + i * RECV_BUF_SIZE
+            self._iov[i].iov_len = RECV_BUF_SIZE
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iov[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+
+    def recv(self) -> list[memoryview]:
+        if self._recvmmsg is None:
+            try:
+                n = self.sock.recv_into(self._buf)
+            except (BlockingIOError, InterruptedError):
+                return []
+            return [self._mv[:n]]
+
+        n = self._recvmmsg(self.sock.fileno(), self._msgs, len(self._msgs), socket.MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+
+        pkts = []
+        for i in range(n):
+            start = i * RECV_BUF_SIZE
+            pkts.append(self._mv[start:start + self._msgs[i].msg_len])
+        return pkts
+
 
 def parse_title(sdp: str) -> str | None:
-    for line in sdp.splitlines():
-        if line.startswith("s="):
-            return line[2:].strip()
-    return None
+    m = _TITLE_RE.search(sdp)
+    return m.group(1).strip() if m else None
+
+
+def parse_sap(pkt: memoryview) -> tuple[bool, int, memoryview] | None:
+    """Split a SAP packet into (deletion, msg_id, payload); None if it is too short.
+
+    The payload is a view into `pkt`, so nothing is copied until the caller needs the SDP.
+    """
+    if len(pkt) < 8:
+        return None
+
+    b0, auth_len, msg_id = _SAP_HDR.unpack_from(pkt)
+    deletion = bool((b0 >> 2) & 1)
+    off = 4 + 4  # skip IPv4 source
+    off += auth_len * 4
+    return deletion, msg_id, pkt[off:]
+
+
+def write_sdp(path: str, data: bytes):
+    """Publish an SDP file atomically: raw fd write to a temp file, then rename over (no fsync)."""
+    tmp = path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(tmp, path)
+    except BaseException:
+        # Don't leave a partial temp file next to the published SDPs.
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def apply_write(path: str, data: bytes | None):
+    """Publish `data` at `path`, or remove the file when `data` is None."""
+    try:
+        if data is None:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        else:
+            write_sdp(path, data)
+    except OSError as e:
+        print(f"Failed to update {path}: {e}")
+
 
 def main():
     ap = argparse.ArgumentParser(description="SAP receiver that writes SDP files and expires stale entries")
@@ -26,74 +188,147 @@ def main():
 
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        # Lets several listeners share the SAP port on BSD/macOS too (Linux already allows it via SO_REUSEADDR).
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if sys.platform.startswith("linux"):
+        # Only deliver groups joined on this socket, not every group any socket on the host joined for this port.
+        s.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
     s.bind(("", SAP_PORT))
+    # Room for announcement bursts while we are busy; the kernel caps this at net.core.rmem_max.
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_SOCK_BUF)
     mreq = struct.pack("=4s4s", socket.inet_aton(SAP_GRP), socket.inet_aton("0.0.0.0"))
     s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
 
     print("Listening for SAP…")
 
     # msg_id -> info
-    seen: dict[int, dict] = {}
-
-    def sweeper():
-        while True:
-            now = time.time()
-            to_delete = []
-            for mid, info in list(seen.items()):
-                if now - info["last_seen"] > args.expire_sec:
-                    to_delete.append(mid)
-            for mid in to_delete:
-                info = seen.pop(mid, None)
-                if info:
-                    try:
-                        Path(info["path"]).unlink(missing_ok=True)
-                    except Exception:
-                        pass
-                    print(f"Expired: {info['title']} ({mid}) → removed {info['path']}")
-            time.sleep(30)
-
-    threading.Thread(target=sweeper, daemon=True).start()
-
-    while True:
-        pkt, _ = s.recvfrom(65535)
-        if len(pkt) < 8:
-            continue
-
-        b0, auth_len, msg_id = struct.unpack("!BBH", pkt[:4])
-        deletion = (b0 >> 2) & 1
-        off = 4 + 4  # skip IPv4 source
-        off += auth_len * 4
-        sdp = pkt[off:].decode("utf-8", "replace").strip()
+    seen: dict[int, SapEntry] = {}
+    # (deadline, msg_id) min-heap. Re-announces only move last_seen; an entry is
+    # re-queued with the real deadline when its old one pops. info.queued is the
+    # deadline of the session's live entry, so leftovers (e.g. from a deleted session
+    # whose msg_id was announced again) are recognised and dropped.
+    expiry_heap: list[tuple[float, int]] = []
+
+    # Everything below runs on this one loop, so seen/expiry_heap/pending need no locking;
+    # only the file I/O itself is pushed to a small bounded pool, so a burst of new
+    # sessions neither stalls the receiver nor piles up concurrent writers.
+    loop = asyncio.new_event_loop()
+    write_pool = ThreadPoolExecutor(max_workers=WRITE_WORKERS, thread_name_prefix="sdp-write")
+
+    # path -> SDP bytes to publish, or None to remove; coalesced for FLUSH_INTERVAL
+    pending: dict[str, bytes | None] = {}
+    # paths with a write/remove running in write_pool
+    in_flight: set[str] = set()
+    flush_handle: asyncio.TimerHandle | None = None
+
+    def schedule_write(path: str, data: bytes | None):
+        nonlocal flush_handle
+        pending[path] = data
+        if flush_handle is None:
+            flush_handle = loop.call_later(FLUSH_INTERVAL, flush)
+
+    def flush():
+        nonlocal flush_handle
+        flush_handle = None
+        for path in list(pending):
+            if path in in_flight:
+                continue  # keep per-file ordering; picked up by the next flush
+            data = pending.pop(path)
+            in_flight.add(path)
+            fut = loop.run_in_executor(write_pool, apply_write, path, data)
+            fut.add_done_callback(lambda _, path=path: in_flight.discard(path))
+        if pending:
+            flush_handle = loop.call_later(FLUSH_INTERVAL, flush)
+
+    def expire(mid: int, reason: str):
+        info = seen.pop(mid, None)
+        if info is None:
+            print(f"{reason} {mid}")
+            return
+        schedule_write(info.path, None)
+        print(f"{reason}: {info.title} ({mid}) → removed {info.path}")
+
+    def sweep():
+        now = time.time()
+        while expiry_heap and expiry_heap[0][0] <= now:
+            queued, mid = heapq.heappop(expiry_heap)
+            info = seen.get(mid)
+            if info is None or info.queued != queued:
+                continue
+            deadline = info.last_seen + args.expire_sec
+            if deadline > now:
+                info.queued = deadline
+                heapq.heappush(expiry_heap, (deadline, mid))
+                continue
+            expire(mid, "Expired")
+        loop.call_later(SWEEP_INTERVAL, sweep)
+
+    def handle_packet(pkt: memoryview):
+        parsed = parse_sap(pkt)
+        if parsed is None:
+            return
+        deletion, msg_id, payload = parsed
 
         if deletion:
-            info = seen.pop(msg_id, None)
-            if info:
-                try:
-                    Path(info["path"]).unlink(missing_ok=True)
-                except Exception:
-                    pass
-                print(f"Deleted: {info['title']} ({msg_id}) → removed {info['path']}")
-            else:
-                print(f"Deleted {msg_id}")
-            continue
-
-        title = parse_title(sdp) or f"session_{msg_id}"
+            expire(msg_id, "Deleted")
+            return
+
+        now = time.time()
+        info = seen.get(msg_id)
+        if info is not None:
+            # Re-announce of a known session (msg_id is a hash of the SDP): just refresh it,
+            # in place so the entry keeps its queued deadline.
+            info.last_seen = now
+            return
+
+        # Only first sightings get copied out of the receive buffer and decoded.
+        sdp = bytes(payload).strip()
+        title = parse_title(sdp.decode("utf-8", "replace")) or f"session_{msg_id}"
         fname = (title.replace(" ", "_")) + ".sdp"
         fpath = str(out_dir / fname)
 
-        first_time = msg_id not in seen
-        seen[msg_id] = {
-            "title": title,
-            "path": fpath,
-            "last_seen": time.time(),
-            "sdp": sdp,
-        }
+        deadline = now + args.expire_sec
+        seen[msg_id] = SapEntry(title=title, path=fpath, last_seen=now, queued=deadline)
+        heapq.heappush(expiry_heap, (deadline, msg_id))
+        schedule_write(fpath, sdp + b"\n")
+        print(f"New: {title} → queued {fpath}")
+
+    rx = BatchReceiver(s)
+
+    # A receive error is fatal (as it was for the blocking loop): stop the loop, drain
+    # pending writes, then re-raise so the process exits non-zero.
+    recv_error: OSError | None = None
 
-        if first_time:
-            with open(fpath, "w") as f:
-                f.write(sdp + "\n")
-            print(f"New: {title} → wrote {fpath}")
+    def on_readable():
+        nonlocal recv_error
+        try:
+            pkts = rx.recv()
+        except OSError as e:
+            recv_error = e
+            loop.remove_reader(s.fileno())
+            loop.stop()
+            return
+        for pkt in pkts:
+            try:
+                handle_packet(pkt)
+            except Exception:
+                # One bad packet must not take the rest of its batch down with it.
+                traceback.print_exc()
 
+    loop.add_reader(s.fileno(), on_readable)
+    # SIGTERM (systemd, docker stop) stops the loop so the drain below still runs.
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.call_soon(sweep)
+    try:
+        loop.run_forever()
+    finally:
+        write_pool.shutdown(wait=True)
+        for path, data in pending.items():
+            apply_write(path, data)
+        loop.close()
+    if recv_error is not None:
+        raise recv_error
 
 
 if __name__ == "__main__":
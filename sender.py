@@ -21,22 +21,31 @@ Stop with Ctrl-C.
 
 import argparse
 import contextlib
+import functools
 import hashlib
 import os
 import random
 import signal
 import socket
 import struct
-import subprocess
 import sys
 import time
 
+import gi
+
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst  # noqa: E402
+
 
 SAP_GRP = "224.2.127.254"
 SAP_PORT = 9875
 
+_SAP_HDR_PACK = struct.Struct("!BBH").pack
+
 
+@functools.lru_cache(maxsize=1)
 def default_outbound_ip() -> str:
+    """Local IP of the default-route interface; resolved once per process."""
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 53))  # no traffic sent; used to select interface
@@ -76,42 +85,75 @@ def make_sdp(name: str, group: str, port: int, pt: int, enc: str, clock: int,
     return ("\n".join(lines) + "\n").encode("utf-8")
 
 
+@functools.lru_cache(maxsize=8)
+def inet_aton(ipv4: str) -> bytes:
+    return socket.inet_aton(ipv4)
+
+
+@functools.lru_cache(maxsize=64)
 def sap_header(sdp_bytes: bytes, src_ipv4: str) -> bytes:
+    """SAP announcement header for an SDP; memoized since the SDP rarely changes."""
     V, A, R, T, E, C = 1, 0, 0, 0, 0, 0
     b0 = (V << 5) | (A << 4) | (R << 3) | (T << 2) | (E << 1) | C
     auth_len = 0
     msg_id = int.from_bytes(hashlib.sha1(sdp_bytes).digest()[:2], "big")
-    return struct.pack("!BBH", b0, auth_len, msg_id) + socket.inet_aton(src_ipv4)
-
-
-def run_pipeline(group: str, port: int, pt: int, pattern: str, bitrate_kbps: int, ttl: int) -> subprocess.Popen:
-    cmd = [
-        "gst-launch-1.0", "-v",
-        "videotestsrc", "is-live=true", f"pattern={pattern}", "!",
-        "video/x-raw,framerate=30/1", "!",
-        "x264enc", "tune=zerolatency", f"bitrate={bitrate_kbps}",
-        "speed-preset=ultrafast", "key-int-max=30", "rc-lookahead=0", "!",
-        "rtph264pay", f"pt={pt}", "config-interval=1", "!",
-        "udpsink", f"host={group}", f"port={port}", "auto-multicast=true",
-        f"ttl-mc={ttl}", "sync=false",
-    ]
-    print("Launching:", " ".join(cmd))
-    return subprocess.Popen(cmd)
-
-
-def send_sap_loop(name: str, sdp: bytes, src_ip: str, interval: float):
+    return _SAP_HDR_PACK(b0, auth_len, msg_id) + inet_aton(src_ipv4)
+
+
+def run_pipeline(group: str, port: int, pt: int, pattern: str, bitrate_kbps: int, ttl: int) -> Gst.Element:
+    """Build and start the RTP/H.264 pipeline in-process; returns the playing pipeline."""
+    desc = " ! ".join([
+        f"videotestsrc is-live=true pattern={pattern}",
+        "video/x-raw,framerate=30/1",
+        f"x264enc tune=zerolatency bitrate={bitrate_kbps} speed-preset=ultrafast key-int-max=30 rc-lookahead=0",
+        f"rtph264pay pt={pt} config-interval=1",
+        f"udpsink host={group} port={port} auto-multicast=true ttl-mc={ttl} sync=false",
+    ])
+    print("Launching:", desc)
+    pipeline = Gst.parse_launch(desc)
+    if pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+        raise RuntimeError("Failed to start GStreamer pipeline")
+    return pipeline
+
+
+def pipeline_stopped(bus: Gst.Bus) -> Gst.MessageType | None:
+    """Non-blocking check for an error/EOS on the pipeline bus; drops any other queued messages.
+
+    Returns the message type (ERROR or EOS) that stopped the pipeline, or None while it is still running.
+    """
+    msg = bus.pop_filtered(Gst.MessageType.ERROR | Gst.MessageType.EOS)
+    if msg is None:
+        return None
+    if msg.type == Gst.MessageType.ERROR:
+        err, _ = msg.parse_error()
+        print(f"Pipeline error: {err.message}", file=sys.stderr)
+    else:
+        print("Pipeline reached end of stream")
+    return msg.type
+
+
+def send_sap_loop(name: str, sdp: bytes, src_ip: str, interval: float, bus: Gst.Bus) -> Gst.MessageType:
+    """Announce `sdp` until the pipeline stops; returns why it stopped (ERROR or EOS)."""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    # Fix the destination once so each announce is a plain send() without per-call address/route lookup.
+    s.connect((SAP_GRP, SAP_PORT))
     pkt = sap_header(sdp, src_ip) + sdp
 
     # quick startup announcements
     for _ in range(3):
-        s.sendto(pkt, (SAP_GRP, SAP_PORT))
+        s.send(pkt)
         time.sleep(1)
+        stopped = pipeline_stopped(bus)
+        if stopped is not None:
+            return stopped
 
     while True:
-        s.sendto(pkt, (SAP_GRP, SAP_PORT))
+        s.send(pkt)
         time.sleep(interval)
+        stopped = pipeline_stopped(bus)
+        if stopped is not None:
+            return stopped
 
 
 def main():
@@ -145,25 +187,28 @@ def main():
         ttl=args.ttl,
     )
 
-    proc = run_pipeline(group, args.port, args.pt, args.pattern, args.bitrate, args.ttl)
+    Gst.init(None)
+    pipeline = run_pipeline(group, args.port, args.pt, args.pattern, args.bitrate, args.ttl)
+
+    def stop_pipeline():
+        with contextlib.suppress(Exception):
+            pipeline.set_state(Gst.State.NULL)
 
     def shutdown(sig, frame):
         print("\nShutting down sender…")
-        try:
-            proc.terminate()
-            proc.wait(timeout=3)
-        except Exception:
-            with contextlib.suppress(Exception):
-                proc.kill()
+        stop_pipeline()
         sys.exit(0)
 
     signal.signal(signal.SIGINT, shutdown)
     signal.signal(signal.SIGTERM, shutdown)
 
     try:
-        send_sap_loop(args.name, sdp, src_ip, args.sap_interval)
+        stopped = send_sap_loop(args.name, sdp, src_ip, args.sap_interval, pipeline.get_bus())
     finally:
-        shutdown(None, None)
+        stop_pipeline()
+
+    if stopped == Gst.MessageType.ERROR:
+        sys.exit(1)
 
 
 if __name__ == "__main__":